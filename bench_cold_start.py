@@ -0,0 +1,43 @@
+# Benchmark the cold start of the Cloud Function entry point.
+# Compares importing main.py against importing the modules main.py used to load
+# eagerly (google.cloud.storage, google.cloud.bigquery, pandas, numpy, requests).
+#
+# Usage: python bench_cold_start.py [runs]
+
+import os
+import subprocess
+import sys
+import time
+import statistics
+
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+cases = {
+    "eager imports (before)": (
+        "from google.cloud import storage, bigquery\n"
+        "import pandas, numpy, requests\n"
+        "schema = [bigquery.SchemaField('domain', 'STRING')]"
+    ),
+    "import main (lazy)": "import main",
+}
+
+
+# Time a fresh interpreter running the snippet, so nothing is cached in-process
+def time_snippet(snippet):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", snippet],
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return time.perf_counter() - start
+
+
+# Measure the bare interpreter so it can be subtracted from each case
+baseline = statistics.median(time_snippet("pass") for _ in range(runs))
+print(f"Interpreter startup: {baseline * 1000:.1f} ms (median of {runs})")
+
+for name, snippet in cases.items():
+    timings = [time_snippet(snippet) for _ in range(runs)]
+    median = statistics.median(timings)
+    print(f"{name}: {median * 1000:.1f} ms total, {(median - baseline) * 1000:.1f} ms over startup")
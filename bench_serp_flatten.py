@@ -0,0 +1,81 @@
+# Benchmark flattening a top-results page: pd.json_normalize against the
+# purpose-built flattener and the streaming parser in serp_parser.py.
+#
+# Usage: python bench_serp_flatten.py [keywords per page ...]   (default 100 1000 10000)
+
+import json
+import sys
+import time
+
+import pandas as pd
+
+import serp_parser
+from main import result_fields
+
+sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+results_per_keyword = 100
+
+
+# Synthetic page in the shape returned by keywords/top-results
+def make_page(keywords):
+    page = []
+    for keyword_id in range(keywords):
+        page.append({
+            "keyword_id": keyword_id,
+            "keyword": f"keyword {keyword_id}",
+            "top_100_results": [
+                {
+                    "domain": f"domain{rank % 37}.co.uk",
+                    "rank": rank,
+                    "landing_page": f"https://domain{rank % 37}.co.uk/page/{keyword_id}",
+                    "title": f"Title for result {rank}",
+                    "description": f"Description for result {rank} of keyword {keyword_id}",
+                    "search_intent": "informational",
+                }
+                for rank in range(1, results_per_keyword + 1)
+            ],
+        })
+    return page
+
+
+def json_normalize(page):
+    return pd.json_normalize(
+        data=page,
+        record_path=["top_100_results"],
+        meta=["keyword_id", "keyword"],
+        errors="ignore",
+    )
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+for keywords in sizes:
+    page = make_page(keywords)
+    body = json.dumps(page).encode("utf-8")
+
+    normalize_time, normalized = time_call(json_normalize, page)
+    flatten_time, flattened = time_call(serp_parser.flatten_top_results, page, result_fields)
+    stream_time, (streamed, _) = time_call(
+        serp_parser.stream_top_results, FakeResponse(body), result_fields
+    )
+    # The baseline parses the body first, so include json.loads for a fair comparison
+    loads_time, _ = time_call(json.loads, body)
+
+    assert len(normalized) == len(flattened) == len(streamed)
+    print(f"{keywords} keywords ({len(flattened)} rows, {len(body) / 1e6:.1f} MB):")
+    print(f"  json.loads + json_normalize: {(loads_time + normalize_time) * 1000:.0f} ms")
+    print(f"  json.loads + flatten_top_results: {(loads_time + flatten_time) * 1000:.0f} ms")
+    print(f"  stream_top_results: {stream_time * 1000:.0f} ms")
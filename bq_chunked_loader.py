@@ -0,0 +1,128 @@
+# Bounded-memory BigQuery loading for the multi-location scripts. Rows are
+# streamed into size-bounded NDJSON files which are submitted as concurrent
+# load jobs, so only a handful of chunks are ever held at once. The chunks
+# land in a staging table that is copied into the target in one job, so the
+# target gets either every row or none of them.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import bigquery
+
+import pipeline
+
+# Bytes of NDJSON written to a chunk before it is submitted as a load job
+chunk_bytes = int(os.getenv("BQ_CHUNK_BYTES", 64 * 1024 * 1024))
+# Number of load jobs running at the same time
+load_workers = int(os.getenv("BQ_LOAD_WORKERS", 4))
+# Attempts per chunk before the load is given up
+max_attempts = 3
+
+
+# Submit one NDJSON chunk as a load job, retrying with backoff on failure
+def _load_chunk(client, table_ref, job_config, chunk):
+    path, index, rows, size = chunk
+    try:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                with open(path, "rb") as file:
+                    load_job = client.load_table_from_file(file, table_ref, job_config=job_config)
+                load_job.result()  # Wait for the job to complete
+                print(f"Loaded chunk {index}: {rows} rows, {size} bytes.")
+                return
+            except Exception as e:
+                if attempt == max_attempts:
+                    raise
+                wait = 2 ** attempt
+                print(f"Chunk {index} failed on attempt {attempt} ({e}), retrying in {wait} seconds...")
+                time.sleep(wait)
+    finally:
+        os.remove(path)
+
+
+# Hours a staging table is kept if a run dies before removing it
+staging_expiry_hours = 24
+
+
+# Create an empty staging table shaped like table_ref, partitioning and
+# clustering included so it can be copied straight into it
+def _create_staging_table(client, table_ref):
+    target = client.get_table(table_ref)
+    stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    staging_ref = client.dataset(table_ref.dataset_id).table(f"{table_ref.table_id}_staging_{stamp}")
+    staging = bigquery.Table(staging_ref, schema=target.schema)
+    staging.time_partitioning = target.time_partitioning
+    staging.clustering_fields = target.clustering_fields
+    staging.expires = datetime.now(timezone.utc) + timedelta(hours=staging_expiry_hours)
+    client.create_table(staging)
+    return staging_ref
+
+
+# Stream rows (dicts) into NDJSON chunks, load them into a staging table and
+# copy that into table_ref in one job. A failed chunk leaves table_ref
+# untouched. Returns the number of rows loaded.
+def load_rows_in_chunks(client, table_ref, rows, job_config,
+                        max_chunk_bytes=chunk_bytes, workers=load_workers):
+    staging_ref = _create_staging_table(client, table_ref)
+    try:
+        total_rows = _load_chunks(client, staging_ref, rows, job_config, max_chunk_bytes, workers)
+        if total_rows:
+            copy_config = bigquery.CopyJobConfig(write_disposition="WRITE_APPEND")
+            client.copy_table(staging_ref, table_ref, job_config=copy_config).result()
+            print(f"Copied {total_rows} rows from {staging_ref.table_id} into {table_ref.table_id}.")
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+    return total_rows
+
+
+def _load_chunks(client, table_ref, rows, job_config, max_chunk_bytes, workers):
+    local_dir = tempfile.mkdtemp(prefix="bq_chunks_")
+    # The bounded queue keeps at most a few finished chunks waiting on disk
+    loader = pipeline.BackgroundWorker(
+        lambda chunk: _load_chunk(client, table_ref, job_config, chunk),
+        maxsize=workers,
+        workers=workers,
+    )
+
+    total_rows = 0
+    index = 0
+    file = None
+    try:
+        for row in rows:
+            if file is None:
+                path = os.path.join(local_dir, f"chunk-{index:05d}.json")
+                file = open(path, "wb")
+                chunk_rows = 0
+                size = 0
+            line = (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+            file.write(line)
+            chunk_rows += 1
+            size += len(line)
+            if size >= max_chunk_bytes:
+                file.close()
+                file = None
+                loader.submit((path, index, chunk_rows, size))
+                total_rows += chunk_rows
+                index += 1
+
+        if file is not None:
+            file.close()
+            file = None
+            loader.submit((path, index, chunk_rows, size))
+            total_rows += chunk_rows
+            index += 1
+    finally:
+        if file is not None:
+            file.close()
+        try:
+            loader.close()
+        finally:
+            # Remove the directory along with any chunk a failed load left unloaded
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+    print(f"Loaded {total_rows} rows in {index} chunks into {table_ref.table_id}.")
+    return total_rows
@@ -0,0 +1,94 @@
+# Fetch planning for the SERP stage of main.py. Picks the keywords and the
+# per-device depth that are actually reported on, skips devices that are not
+# needed at all and trims everything else client-side before the merge, as
+# the top-results endpoint has no keyword filter.
+
+import os
+
+# Full depth of the top-results endpoint
+full_depth = 100
+
+
+# Rules come from the environment:
+#   SERP_PLAN_MAIN_ONLY=1              only main keywords, no variants
+#   SERP_PLAN_GROUPS=Group A,Group B   only keywords in any of these groups
+#   SERP_PLAN_DEPTH_DESKTOP=20         results kept per keyword, 0 skips the device
+#   SERP_PLAN_DEPTH_MOBILE=20
+def rules_from_env():
+    groups = os.getenv("SERP_PLAN_GROUPS")
+    return {
+        "main_only": os.getenv("SERP_PLAN_MAIN_ONLY", "0") == "1",
+        "groups": [group.strip() for group in groups.split(",") if group.strip()] if groups else None,
+        "depths": {
+            "desktop": int(os.getenv("SERP_PLAN_DEPTH_DESKTOP", full_depth)),
+            "mobile": int(os.getenv("SERP_PLAN_DEPTH_MOBILE", full_depth)),
+        },
+    }
+
+
+class FetchPlan:
+    def __init__(self, keywords_augmented, main_only=False, groups=None, depths=None):
+        self.depths = depths or {}
+        self.total_keywords = len(keywords_augmented)
+
+        selected = keywords_augmented
+        if main_only:
+            selected = selected[~selected["variant_flag"].astype(bool)]
+        if groups:
+            # group_name holds every group of a keyword joined with ", "
+            in_groups = (
+                selected["group_name"].str.split(", ").explode().isin(groups)
+                .groupby(level=0).any()
+            )
+            selected = selected[in_groups.reindex(selected.index, fill_value=False)]
+
+        # None means every keyword is kept and no filtering is needed
+        self.keyword_ids = None
+        if main_only or groups:
+            self.keyword_ids = set(selected["keyword_id"].dropna().tolist())
+
+        self.rows_fetched = 0
+        self.rows_kept = 0
+        # Top-results calls actually made per device
+        self.calls = {}
+
+    def depth(self, device_type):
+        return self.depths.get(device_type, full_depth)
+
+    def should_fetch(self, device_type):
+        return self.depth(device_type) > 0 and self.keyword_ids != set()
+
+    # Drop rows for keywords outside the plan and results past the device depth
+    def trim(self, serp_flat, device_type):
+        self.rows_fetched += len(serp_flat)
+        depth = self.depth(device_type)
+        if self.keyword_ids is not None:
+            serp_flat = serp_flat[serp_flat["keyword_id"].isin(self.keyword_ids)]
+        if depth < full_depth:
+            rank = serp_flat["rank"]
+            # Rows without a rank are kept so validation can quarantine them
+            serp_flat = serp_flat[(rank.isna() | (rank <= depth)).astype(bool)]
+        self.rows_kept += len(serp_flat)
+        return serp_flat
+
+    # Count one top-results request made for a device
+    def record_call(self, device_type):
+        self.calls[device_type] = self.calls.get(device_type, 0) + 1
+
+    def describe(self):
+        kept = self.total_keywords if self.keyword_ids is None else len(self.keyword_ids)
+        depths = ", ".join(f"{device}: {depth}" for device, depth in self.depths.items())
+        return f"{kept} of {self.total_keywords} keywords, depth per device {depths}"
+
+    def report(self):
+        calls = ", ".join(f"{device}: {self.calls.get(device, 0)}" for device in self.depths)
+        skipped = [device for device in self.depths if not self.should_fetch(device)]
+        saved = ""
+        if skipped and self.calls:
+            # Every device pages through the same keywords, so a skipped device
+            # would have needed about as many calls as a fetched one made
+            saved = f", skipping {', '.join(skipped)} saved about {max(self.calls.values()) * len(skipped)} calls"
+        print(
+            f"Fetch plan made top-results calls per device ({calls}){saved} and trimmed "
+            f"{self.rows_fetched - self.rows_kept} of {self.rows_fetched} rows before the merge."
+        )
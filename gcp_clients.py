@@ -0,0 +1,32 @@
+# Google Cloud clients shared by main.py and its helper modules. Each client
+# is created once per instance, on first use, and reused across invocations.
+
+import threading
+
+# Project of the GCS buckets used by main.py
+storage_project = "organic-data"
+
+_storage_client = None
+_bigquery_client = None
+# Pages are fetched on background threads, so creation is guarded
+_lock = threading.Lock()
+
+
+def get_storage_client(project=storage_project):
+    global _storage_client
+    with _lock:
+        if _storage_client is None:
+            from google.cloud import storage
+
+            _storage_client = storage.Client(project=project)
+    return _storage_client
+
+
+def get_bigquery_client(project):
+    global _bigquery_client
+    with _lock:
+        if _bigquery_client is None:
+            from google.cloud import bigquery
+
+            _bigquery_client = bigquery.Client(project=project)
+    return _bigquery_client
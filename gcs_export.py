@@ -0,0 +1,147 @@
+# Chunked, gzip-compressed CSV export to GCS for main.py. Rows are written into
+# size-bounded .csv.gz chunks which upload concurrently as soon as they are
+# closed, and the whole export is then loaded with one wildcard URI.
+
+import gzip
+import os
+import shutil
+import tempfile
+
+import pipeline
+
+# Uncompressed bytes written to a chunk before it is closed and uploaded
+chunk_bytes = int(os.getenv("EXPORT_CHUNK_BYTES", 32 * 1024 * 1024))
+# Number of chunks uploading at the same time
+upload_workers = int(os.getenv("EXPORT_UPLOAD_WORKERS", 4))
+# gzip level, lower is faster while still shrinking CSV several times over
+compress_level = 6
+
+
+# Stand-in for a google.cloud.storage bucket that writes blobs under a local
+# directory, so the export can be exercised without GCS
+class LocalBucket:
+    def __init__(self, root, name="local"):
+        self.root = root
+        self.name = name
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+    def list_blobs(self, prefix=""):
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if name.startswith(prefix):
+                    blobs.append(LocalBlob(self, name))
+        return blobs
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_filename(self, filename, content_type=None):
+        path = os.path.join(self.bucket.root, self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+
+    def delete(self):
+        os.remove(os.path.join(self.bucket.root, self.name))
+
+
+# Writes DataFrames into gzip CSV chunks under gs://<bucket>/<prefix>/ and
+# uploads each finished chunk in the background
+class ChunkedExport:
+    def __init__(self, bucket, prefix, max_chunk_bytes=chunk_bytes, workers=upload_workers):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_chunk_bytes = max_chunk_bytes
+        self.local_dir = tempfile.mkdtemp(prefix="serp_export_")
+        self.chunks = 0
+        self.rows = 0
+        self._file = None
+        self._path = None
+        self._chunk_bytes = 0
+        self._closed = False
+        # The bounded queue means at most a few finished chunks wait on disk
+        self._uploader = pipeline.BackgroundWorker(self._upload, maxsize=workers, workers=workers)
+
+    # Wildcard URI matching every chunk of this export
+    @property
+    def uri(self):
+        return f"gs://{self.bucket.name}/{self.prefix}/*.csv.gz"
+
+    def _open_chunk(self):
+        name = f"chunk-{self.chunks:05d}.csv.gz"
+        self._path = os.path.join(self.local_dir, name)
+        self._file = gzip.open(self._path, "wb", compresslevel=compress_level)
+        self._chunk_bytes = 0
+        self.chunks += 1
+
+    def _close_chunk(self):
+        self._file.close()
+        self._uploader.submit(self._path)
+        self._file = None
+        self._path = None
+
+    def _upload(self, path):
+        blob_name = f"{self.prefix}/{os.path.basename(path)}"
+        self.bucket.blob(blob_name).upload_from_filename(path, content_type="application/gzip")
+        os.remove(path)  # /tmp is in memory on Cloud Functions, so free it straight away
+        print(f"File {path} uploaded to {blob_name} in bucket {self.bucket.name}.")
+
+    # Append a DataFrame to the current chunk, starting a new one once it is full
+    def write_frame(self, df):
+        if df.empty:
+            return
+        if self._file is None:
+            self._open_chunk()
+        data = df.to_csv(index=False, header=False, na_rep="").encode("utf-8")
+        self._file.write(data)
+        self._chunk_bytes += len(data)
+        self.rows += len(df)
+        if self._chunk_bytes >= self.max_chunk_bytes:
+            self._close_chunk()
+
+    # Upload the last chunk and wait for every upload to finish
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            self._close_chunk()
+        try:
+            self._uploader.close()
+        except Exception:
+            # An export missing a chunk is never loaded, so remove what did upload
+            self.delete()
+            raise
+        finally:
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+        print(f"Exported {self.rows} rows in {self.chunks} chunks to {self.uri}")
+
+    # Tear down an export that will not be loaded: the partial chunk, the
+    # temporary directory, the uploader threads and anything already uploaded.
+    # Does nothing once close() has run, which cleans up after itself on failure.
+    def abort(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            self._uploader.close()
+        except Exception as e:
+            print(f"Upload failed while aborting the export to {self.uri}: {e}")
+        finally:
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+        self.delete()
+        print(f"Export to {self.uri} aborted.")
+
+    # Delete every uploaded chunk of this export, once it has been loaded
+    def delete(self):
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}/"):
+            blob.delete()
@@ -1,10 +1,18 @@
 import os
-from google.cloud import storage, bigquery
-import pandas as pd
-import requests
-import numpy as np
+import json
 from datetime import datetime
 import time
+import serp_checkpoint
+import pipeline
+import gcs_export
+import page_size
+import fetch_plan
+# Clients are created once per instance and reused across invocations
+from gcp_clients import get_storage_client, get_bigquery_client
+
+# pandas, numpy, requests, the google.cloud clients and the helper modules built
+# on pandas are imported lazily by the stage that needs them, so a cold start
+# only pays for what the entry point touches
 
 # Load environment variables from .env file if present
 if os.path.exists('.env'):
@@ -16,87 +24,259 @@ campaign_id = os.getenv("CAMPAIGN_ID")
 project_id = os.getenv("PROJECT_ID")
 bucket_name = os.getenv("BUCKET_NAME")
 dest_file_name = os.getenv("DEST_FILE_NAME")
-
-current_date = datetime.now().strftime("%Y-%m-%d")
-
-# Manually define the schema
+# Parse top-results responses incrementally, set SERP_STREAMING=0 to parse each page whole
+serp_streaming = os.getenv("SERP_STREAMING", "1") != "0"
+# Page sizes the keywords and top-results endpoints are known to accept
+keyword_page_size = 1000
+serp_page_size = 100
+# Bounds for the adaptive page sizes, by default never above the known sizes
+keyword_page_bounds = (
+    int(os.getenv("KEYWORD_PAGE_MIN", 100)),
+    int(os.getenv("KEYWORD_PAGE_MAX", keyword_page_size)),
+)
+serp_page_bounds = (
+    int(os.getenv("SERP_PAGE_MIN", 10)),
+    int(os.getenv("SERP_PAGE_MAX", serp_page_size)),
+)
+# Consecutive timeouts, 524s or refused page sizes tolerated before giving up
+max_timeouts = 5
+# Safety cap on the pages fetched per endpoint and device, far beyond any
+# campaign, in case the API never signals the end of the data
+max_pages = 10000
+# Write the export to this directory instead of GCS, for local testing
+local_bucket_dir = os.getenv("LOCAL_BUCKET_DIR")
+# Local memory-mapped rank history of HISTORY_DOMAIN, only kept when both are set
+history_dir = os.getenv("HISTORY_DIR")
+history_domain = os.getenv("HISTORY_DOMAIN")
+
+
+# A 4xx other than the end of data 404 or a 429 on a page larger than the API is
+# known to accept means the page size was refused, not that the data has ended
+def page_size_refused(status_code, limit, accepted_size):
+    return 400 <= status_code < 500 and status_code not in (404, 429) and limit > accepted_size
+
+
+# Manually define the schema as (name, type) pairs, turned into
+# bigquery.SchemaField objects only when the load stage runs
 schema = [
-    bigquery.SchemaField("domain", "STRING"),
-    bigquery.SchemaField("rank", "INTEGER"),
-    bigquery.SchemaField("landing_page", "STRING"),
-    bigquery.SchemaField("title", "STRING"),
-    bigquery.SchemaField("description", "STRING"),
-    bigquery.SchemaField("search_intent", "STRING"),
-    bigquery.SchemaField("keyword_id", "STRING"),
-    bigquery.SchemaField("keyword", "STRING"),
-    bigquery.SchemaField("main_keyword_id", "STRING"),
-    bigquery.SchemaField("search_volume", "INTEGER"),
-    bigquery.SchemaField("variant_flag", "BOOL"),
-    bigquery.SchemaField("group_name", "STRING"),
-    bigquery.SchemaField("parent_group_id", "STRING"),
-    bigquery.SchemaField("main_keyword", "STRING"),
-    bigquery.SchemaField("campaign_id", "STRING"),
-    bigquery.SchemaField("date", "DATE"),
-    bigquery.SchemaField("device", "STRING"),
+    ("domain", "STRING"),
+    ("rank", "INTEGER"),
+    ("landing_page", "STRING"),
+    ("title", "STRING"),
+    ("description", "STRING"),
+    ("search_intent", "STRING"),
+    ("keyword_id", "STRING"),
+    ("keyword", "STRING"),
+    ("main_keyword_id", "STRING"),
+    ("search_volume", "INTEGER"),
+    ("variant_flag", "BOOL"),
+    ("group_name", "STRING"),
+    ("parent_group_id", "STRING"),
+    ("main_keyword", "STRING"),
+    ("campaign_id", "STRING"),
+    ("date", "DATE"),
+    ("device", "STRING"),
 ]
 
-def main(request=None):
+# Fields of the schema that come from each entry of top_100_results, picked by
+# name so the order of the schema entries does not change the flattened columns
+result_field_names = ["domain", "rank", "landing_page", "title", "description", "search_intent"]
+result_fields = [(name, dict(schema)[name]) for name in result_field_names]
 
-    # Step one, fetch keyword data
-    # Initialise variables
-    offset = 0
-    limit = 1000
-    status_code = 200  # Assume initial status code to start the loop
+# Build the BigQuery schema from the (name, type) pairs
+def get_bigquery_schema(fields):
+    from google.cloud import bigquery
 
-    # Initialize an empty DataFrame for keywords data
-    keywords_df = pd.DataFrame()
+    return [bigquery.SchemaField(name, field_type) for name, field_type in fields]
+
+
+# Tables are partitioned by date and clustered on the columns reports filter on
+serp_partition_field = "date"
+serp_clustering_fields = ["keyword_id", "device", "domain"]
+visibility_clustering_fields = ["group_name", "device", "domain"]
 
-    while status_code == 200:
-        url = f"https://apigw.seomonitor.com/v3/rank-tracker/v3.0/keywords?campaign_id={campaign_id}&start_date={current_date}&end_date={current_date}&limit={limit}&offset={offset}&include_all_groups=true"
 
-        headers = {"Accept": "*/*", "Authorization": api_key}
-        print(f"Requesting URL: {url}")
+def _table_exists(client, dataset_id, table_id):
+    from google.cloud.exceptions import NotFound
+
+    try:
+        client.get_table(client.dataset(dataset_id).table(table_id))
+    except NotFound:
+        return False
+    return True
+
+
+# Create a table partitioned and clustered, or migrate an existing one
+def create_partitioned_table(client, dataset_id, table_id, schema, clustering_fields):
+    from google.cloud import bigquery
+    from google.cloud.exceptions import NotFound
+
+    table_ref = client.dataset(dataset_id).table(table_id)
+    full_id = f"{client.project}.{dataset_id}.{table_id}"
+    rebuilt_id = f"{table_id}_partitioned"
+    backup_id = f"{table_id}_unpartitioned_backup"
+    try:
+        table = client.get_table(table_ref)  # Check if table exists
+    except NotFound:
+        if _table_exists(client, dataset_id, rebuilt_id):
+            # A migration stopped after moving the original to the backup, finish it
+            client.query(f"ALTER TABLE `{full_id}_partitioned` RENAME TO `{table_id}`").result()
+            print(f"Table {table_id} migration completed from {rebuilt_id}.")
+            return
+        table = bigquery.Table(table_ref, schema=get_bigquery_schema(schema))
+        table.time_partitioning = bigquery.TimePartitioning(field=serp_partition_field)
+        table.clustering_fields = clustering_fields
+        client.create_table(table)
+        print(f"Table {table_id} created, partitioned by {serp_partition_field} and clustered on {clustering_fields}.")
+        return
+
+    partitioning = table.time_partitioning
+    if partitioning is None or partitioning.field != serp_partition_field:
+        # Partitioning cannot be changed in place, so rebuild the table from its
+        # history and keep the original alongside as a backup. Every step can be
+        # repeated, so a migration that failed partway is redone by the next run.
+        print(f"Migrating {table_id} to a partitioned and clustered table, original kept as {backup_id}...")
+        client.query(
+            f"CREATE OR REPLACE TABLE `{full_id}_partitioned` "
+            f"PARTITION BY {serp_partition_field} "
+            f"CLUSTER BY {', '.join(clustering_fields)} "
+            f"AS SELECT * FROM `{full_id}`"
+        ).result()
+        client.query(f"CREATE OR REPLACE TABLE `{full_id}_unpartitioned_backup` COPY `{full_id}`").result()
+        client.query(f"DROP TABLE `{full_id}`").result()
+        client.query(f"ALTER TABLE `{full_id}_partitioned` RENAME TO `{table_id}`").result()
+        print(f"Table {table_id} migrated.")
+    elif table.clustering_fields != clustering_fields:
+        # Clustering can be updated in place, it applies to data written from now on
+        table.clustering_fields = clustering_fields
+        client.update_table(table, ["clustering_fields"])
+        print(f"Table {table_id} clustering updated to {clustering_fields}.")
+    else:
+        print(f"Table {table_id} already exists.")
+
+def main(request=None):
+    import pandas as pd
+    import requests
+    import rank_history
+    import serp_aggregates
+    import serp_parser
+    import serp_validator
+
+    # The date is taken per invocation, a warm instance can outlive the day
+    date_str = datetime.now().strftime("%Y-%m-%d")
+
+    # Fail early if checkpoints would be lost with the instance
+    serp_checkpoint.check_storage()
+
+    headers = {"Accept": "*/*", "Authorization": api_key}
+
+    # Step 2 runs in the background, fetching group data while the keywords page in
+    def fetch_groups():
+        url = f"https://apigw.seomonitor.com/v3/rank-tracker/v3.0/groups?campaign_id={campaign_id}"
         response = requests.get(url, headers=headers, timeout=120)
-        status_code = response.status_code
-
-        if status_code == 200:
-            json_content = response.json()  # Directly parse the JSON response
-            kwds = pd.json_normalize(json_content)  # Convert JSON to DataFrame
-            kwds["variant_flag"] = ~kwds[
-                "main_keyword_id"
-            ].isna()  # Create variant_flag
-
-            # Select specific columns to form 'reference_list'
-            reference_list = kwds[
-                [
-                    "keyword_id",
-                    "keyword",
-                    "main_keyword_id",
-                    "groups",
-                    "search_data.search_volume",
-                    "variant_flag",
-                ]
-            ]
+        return response.json()  # Directly get the JSON response
+
+    groups_call = pipeline.BackgroundCall(fetch_groups)
 
-            # Append the reference_list DataFrame to the main keywords DataFrame
-            keywords_df = pd.concat([keywords_df, reference_list], ignore_index=True)
+    # Step one, fetch keyword data
+    # Yield each page of keywords, the next page downloads while this one is processed
+    def iter_keyword_pages():
+        # Initialise variables
+        offset = 0
+        pages = 0
+        failures = 0  # Consecutive timeouts, 524s and refused page sizes
+        page_sizes = page_size.PageSizeController(
+            campaign_id, "keywords", keyword_page_size, keyword_page_bounds[0], keyword_page_bounds[1]
+        )
+
+        while pages < max_pages:
+            limit = page_sizes.size
+            url = f"https://apigw.seomonitor.com/v3/rank-tracker/v3.0/keywords?campaign_id={campaign_id}&start_date={date_str}&end_date={date_str}&limit={limit}&offset={offset}&include_all_groups=true"
 
-            offset += limit
-            print(f"Fetched and appended keywords with offset {offset}")
+            print(f"Requesting URL: {url}")
+            start = time.perf_counter()
+            try:
+                response = requests.get(url, headers=headers, timeout=120)
+            except requests.exceptions.Timeout:
+                # Retry timed out pages with a smaller page, but not forever
+                failures += 1
+                if failures > max_timeouts:
+                    raise
+                page_sizes.record_failure("timeout")
+                print(f"Request timed out ({failures}/{max_timeouts}), retrying...")
+                continue
+            status_code = response.status_code
+
+            if status_code == 200:
+                json_content = response.json()  # Directly parse the JSON response
+                if not json_content:
+                    print(f"No more keywords after offset {offset}.")
+                    break
+                failures = 0
+                page_sizes.record_success(time.perf_counter() - start, len(response.content))
+                yield json_content
+                offset += limit
+                pages += 1
+                print(f"Fetched keywords with offset {offset}")
+            elif status_code == 524 or page_size_refused(status_code, limit, keyword_page_size):
+                # Retry with a smaller page, but not forever
+                failures += 1
+                if failures > max_timeouts:
+                    raise RuntimeError(
+                        f"Keywords request failed {failures} times in a row, last with status code {status_code}"
+                    )
+                if status_code == 524:
+                    page_sizes.record_failure("status code 524")
+                    print("Received status code 524, waiting 30 seconds before retrying...")
+                    time.sleep(30)
+                else:
+                    page_sizes.record_refused(limit, keyword_page_size)
+                    print(f"Page size {limit} refused with status code {status_code}, retrying with a smaller page...")
+            elif status_code == 404:
+                # The API answers past the last page with a 404
+                print(f"No more keywords after offset {offset}.")
+                break
+            else:
+                # A truncated keyword list would leave SERP rows without their
+                # keyword data, so fail the run instead
+                raise RuntimeError(f"Keywords request failed at offset {offset} with status code {status_code}")
         else:
-            print(f"Received status code {status_code}, stopping...")
+            raise RuntimeError(f"Stopped keywords at the safety cap of {max_pages} pages.")
 
-    # Convert 'None' values to np.nan in 'main_keyword_id' for the entire DataFrame
-    keywords_df["main_keyword_id"] = keywords_df["main_keyword_id"].apply(
-        lambda x: np.nan if x is None else x
-    )
+        page_sizes.save()
 
-    # Step 2, fetch group data
-    url = f"https://apigw.seomonitor.com/v3/rank-tracker/v3.0/groups?campaign_id={campaign_id}"
-    headers = {"Accept": "*/*", "Authorization": api_key}
+    # Initialize an empty DataFrame for keywords data
+    keywords_df = pd.DataFrame()
+
+    for json_content in pipeline.background_iter(iter_keyword_pages()):
+        kwds = pd.json_normalize(json_content)  # Convert JSON to DataFrame
+        kwds["variant_flag"] = ~kwds[
+            "main_keyword_id"
+        ].isna()  # Create variant_flag
+
+        # Select specific columns to form 'reference_list'
+        reference_list = kwds[
+            [
+                "keyword_id",
+                "keyword",
+                "main_keyword_id",
+                "groups",
+                "search_data.search_volume",
+                "variant_flag",
+            ]
+        ]
+
+        # Append the reference_list DataFrame to the main keywords DataFrame
+        keywords_df = pd.concat([keywords_df, reference_list], ignore_index=True)
 
-    response = requests.get(url, headers=headers, timeout=120)
-    groups = response.json()  # Directly get the JSON response
+    # Keep keyword ids as nullable integers, missing main_keyword_id values become <NA>.
+    # Ids sent as JSON strings are converted too, anything non-numeric is an error
+    # rather than a keyword silently dropped by the groupby below.
+    for column in ["keyword_id", "main_keyword_id"]:
+        keywords_df[column] = pd.to_numeric(keywords_df[column], errors="raise").astype("Int64")
+
+    # Step 2, collect the group data fetched in the background
+    groups = groups_call.result()
 
     # Recursive function to process groups
     def process_groups(groups, parent_id=pd.NA):
@@ -153,41 +333,29 @@ def main(request=None):
         .reset_index()
     )
 
-    # Prepare a DataFrame for the join
-    main_keywords = keywords_augmented[["keyword_id", "keyword"]].rename(
-        columns={"keyword": "main_keyword"}
+    # Resolve main_keyword through an id -> keyword index rather than a self-merge
+    main_keyword_index = pd.Series(
+        keywords_augmented["keyword"].to_numpy(), index=keywords_augmented["keyword_id"]
     )
-
-    keywords_augmented["main_keyword_id"] = keywords_augmented[
-        "main_keyword_id"
-    ].astype(str)
-    main_keywords["keyword_id"] = main_keywords["keyword_id"].astype(str)
-
-    # Perform the left join
-    keywords_augmented = pd.merge(
-        keywords_augmented,
-        main_keywords,
-        left_on="main_keyword_id",
-        right_on="keyword_id",
-        how="left",
-        suffixes=("", "_main"),
+    keywords_augmented["main_keyword"] = keywords_augmented["main_keyword_id"].map(
+        main_keyword_index
     )
 
-    # Clean up the resulting DataFrame if necessary
-    keywords_augmented.drop(columns=["keyword_id_main"], inplace=True)
-    # Convert 'None' values to np.nan in 'main_keyword_id' for the entire DataFrame
-    keywords_augmented["main_keyword_id"] = keywords_augmented[
-        "main_keyword_id"
-    ].replace("None", np.nan)
-
     # Exporting DataFrame to CSV with default handling of NaN values (empty strings) for testing purposes
     # keywords_augmented.to_csv("keywords_augmented.csv", index=False)
 
     # Step 4, fetch SERP data
-    date_str = datetime.now().strftime("%Y-%m-%d")
+    # Pages of earlier dates can never be resumed, so do not let them pile up
+    serp_checkpoint.clear_stale_checkpoints(campaign_id, date_str)
 
     # Additional step to try and clean out malformed data
     def clean_data(df, schema):
+        # Write nullable integer ids as plain digits, with missing ids left empty
+        for name, field_type in schema:
+            if field_type == "STRING" and pd.api.types.is_extension_array_dtype(df[name]) \
+                    and pd.api.types.is_integer_dtype(df[name]):
+                df[name] = df[name].astype(object).where(df[name].notna(), '')
+
         # Fill missing values with appropriate defaults before type conversion
         df = df.fillna({
             'main_keyword_id': '',
@@ -200,88 +368,144 @@ def main(request=None):
         df = df.applymap(lambda x: str(x).strip() if isinstance(x, str) else x)
         
         # Ensure data types match the schema
-        for field in schema:
-            if field.field_type == "INTEGER":
-                df[field.name] = pd.to_numeric(df[field.name], errors='coerce').fillna(0).astype(int)
-            elif field.field_type == "BOOL":
-                df[field.name] = df[field.name].astype(bool)
-            elif field.field_type == "DATE":
-                df[field.name] = pd.to_datetime(df[field.name], errors='coerce').dt.date
+        for name, field_type in schema:
+            if field_type == "INTEGER":
+                df[name] = pd.to_numeric(df[name], errors='coerce').fillna(0).astype(int)
+            elif field_type == "BOOL":
+                df[name] = df[name].astype(bool)
+            elif field_type == "DATE":
+                df[name] = pd.to_datetime(df[name], errors='coerce').dt.date
             else:
-                df[field.name] = df[field.name].astype(str)
+                df[name] = df[name].astype(str)
         
-        return df
+        # The CSV is loaded by position, so write the columns in schema order
+        return df[[name for name, _ in schema]]
     
-    def fetch_and_process_serp_data(
-        device_type,
-        campaign_id,
-        date_str,
-        api_key,
-        keywords_augmented,
-        file_path,
-        schema,
-        append=False,
-    ):
+    # Yield each page of flattened SERP data for a device, reusing pages
+    # checkpointed by an earlier run on the same date
+    def iter_serp_pages(device_type, campaign_id, date_str, api_key, plan):
         offset = 0
-        limit = 100
-        status_code = 200
-        max_offset = 10  # Ridiculously high offset cap, just to be safe
+        pages = 0
+        # Consecutive timeouts, 524s and refused page sizes
+        failures = 0
+        # Only set once pagination reaches its end, not when a request fails
+        finished = False
+        page_sizes = page_size.PageSizeController(
+            campaign_id, f"top-results-{device_type}", serp_page_size, serp_page_bounds[0], serp_page_bounds[1]
+        )
 
-        # Initialize an empty DataFrame to accumulate results
-        all_serp_flat = pd.DataFrame()
+        # A device that finished on an earlier run is rebuilt from its checkpoints only
+        device_complete = serp_checkpoint.is_device_complete(campaign_id, date_str, device_type)
+        if device_complete:
+            print(f"{device_type} SERP data already fetched for {date_str}, loading from checkpoints")
+
+        while pages < max_pages:
+            # Reuse any page completed by a previous run on the same date
+            page = serp_checkpoint.load_page(campaign_id, date_str, device_type, offset)
+            if page is not None:
+                offset += page["limit"]
+                pages += 1
+                print(f"Loaded {device_type} SERP data from checkpoint with offset {offset}")
+                yield page["frame"]
+                continue
+            if device_complete:
+                break
 
-        while offset < max_offset and (status_code == 200 or status_code == 524):
+            limit = page_sizes.size
             url = f"https://apigw.seomonitor.com/v3/rank-tracker/v3.0/keywords/top-results?campaign_id={campaign_id}&device={device_type}&date={date_str}&limit={limit}&offset={offset}"
             print(f"Requesting URL: {url}")
-            response = requests.get(
-                url, headers={"Accept": "*/*", "Authorization": api_key}, timeout=120
-            )
+            plan.record_call(device_type)
+            start = time.perf_counter()
+            try:
+                response = requests.get(
+                    url,
+                    headers={"Accept": "*/*", "Authorization": api_key},
+                    timeout=120,
+                    stream=serp_streaming,
+                )
+            except requests.exceptions.Timeout:
+                # Retry timed out pages with a smaller page, but not forever
+                failures += 1
+                if failures > max_timeouts:
+                    raise
+                page_sizes.record_failure("timeout")
+                print(f"Request timed out ({failures}/{max_timeouts}), retrying...")
+                continue
             status_code = response.status_code
 
             if status_code == 200:
-                json_content = response.json()
-                serp_flat = pd.json_normalize(
-                    data=json_content,
-                    record_path=["top_100_results"],
-                    meta=["keyword_id", "keyword"],
-                    errors="ignore",
+                if serp_streaming:
+                    # Read the body incrementally into column buffers
+                    serp_flat, keywords = serp_parser.stream_top_results(response, result_fields)
+                else:
+                    json_content = response.json()
+                    keywords = len(json_content)
+                    serp_flat = serp_parser.flatten_top_results(json_content, result_fields)
+                if keywords == 0:
+                    # A page without keywords is past the end of the data
+                    print(f"No more {device_type} SERP data after offset {offset}.")
+                    finished = True
+                    break
+                failures = 0
+                # Streamed bodies only report their size through Content-Length
+                payload_bytes = response.headers.get("Content-Length")
+                page_sizes.record_success(
+                    time.perf_counter() - start, int(payload_bytes) if payload_bytes else None
                 )
 
-                # Accumulate results
-                all_serp_flat = pd.concat([all_serp_flat, serp_flat], ignore_index=True)
+                # Checkpoint the page before handing it on
+                serp_checkpoint.save_page(campaign_id, date_str, device_type, offset, limit, serp_flat)
 
                 offset += limit
+                pages += 1
                 print(f"Fetched and saved {device_type} SERP data with offset {offset}")
+                yield serp_flat
                 time.sleep(1)  # Throttle requests to avoid hitting rate limits
-            elif status_code == 524:
-                print("Received status code 524, waiting 30 seconds before retrying...")
-                time.sleep(30)
+            elif status_code == 404:
+                # The API answers past the last page with a 404
+                response.close()
+                print(f"No more {device_type} SERP data after offset {offset}.")
+                finished = True
+                break
+            elif status_code == 524 or page_size_refused(status_code, limit, serp_page_size):
+                response.close()  # Release the unread body of a streamed response
+                failures += 1
+                if failures > max_timeouts:
+                    raise RuntimeError(
+                        f"{device_type} SERP request failed {failures} times in a row, "
+                        f"last with status code {status_code}"
+                    )
+                if status_code == 524:
+                    page_sizes.record_failure("status code 524")
+                    print("Received status code 524, waiting 30 seconds before retrying...")
+                    time.sleep(30)
+                else:
+                    page_sizes.record_refused(limit, serp_page_size)
+                    print(f"Page size {limit} refused with status code {status_code}, retrying with a smaller page...")
             else:
+                response.close()
                 print(f"Received status code {status_code}, stopping...")
                 break
+        else:
+            print(f"Stopped {device_type} SERP data at the safety cap of {max_pages} pages.")
+
+        if device_complete:
+            return
+        page_sizes.save()
+        if not finished:
+            # Loading the partial device would let clear_checkpoints delete the pages
+            # a rerun needs, so fail the run and leave them for it to resume from
+            raise RuntimeError(
+                f"{device_type} SERP data stopped at offset {offset} before the end of the data, "
+                f"checkpoints kept so a rerun on {date_str} resumes from there"
+            )
+        serp_checkpoint.mark_device_complete(campaign_id, date_str, device_type)
 
-        # Debugging prints to check columns before the merge
-        print("Columns in all_serp_flat:", all_serp_flat.columns)
-        print("Columns in keywords_augmented:", keywords_augmented.columns)
-
-        # Ensure all necessary columns are present in keywords_augmented
-        required_columns = ['keyword_id', 'keyword', 'main_keyword_id', 'search_data.search_volume',
-                            'variant_flag', 'group_name', 'parent_id', 'main_keyword']
-        for column in required_columns:
-            if column not in keywords_augmented.columns:
-                print(f"Warning: '{column}' column not found in keywords_augmented")
-                keywords_augmented[column] = ''
-
-        # Rename columns to match schema
-        column_renames = {
-            'search_data.search_volume': 'search_volume',
-            'parent_id': 'parent_group_id'
-        }
-        keywords_augmented = keywords_augmented.rename(columns=column_renames)
-
+    # Join one page of SERP data with the keyword data and clean it for export
+    def transform_serp_page(serp_flat, keywords_augmented, campaign_id, date_str, device_type, schema, validator):
         # Process and join this data with keywords_augmented
         final_df = pd.merge(
-            all_serp_flat, keywords_augmented, how="left", on="keyword_id"
+            serp_flat, keywords_augmented, how="left", on="keyword_id"
         )
         final_df["campaign_id"] = campaign_id
         final_df["date"] = date_str
@@ -294,85 +518,158 @@ def main(request=None):
         if 'keyword_y' in final_df.columns:
             final_df = final_df.drop(columns=['keyword_y'])
 
+        # Split off rows that would fail the load before cleaning coerces them
+        final_df, quarantined = validator.validate(final_df)
+
         # Clean the data
         final_df = clean_data(final_df, schema)
 
         # Fill NaN values with empty strings before writing to CSV
-        final_df = final_df.fillna('')
-
-        # Debugging print to check columns after the merge
-        print("Columns in final_df after merge:", final_df.columns)
-
-        # Determine whether to append or write new
-        if append:
-            final_df.to_csv(file_path, mode="a", index=False, header=False, na_rep="", encoding='utf-8')
-        else:
-            final_df.to_csv(file_path, index=False, header=False, na_rep="", encoding='utf-8')
-        print(f"Completed fetching and saving all {device_type} data.")
-
-    # Path for the CSV file, assuming it's the same for both desktop and mobile
-    file_path = f"{dest_file_name}.csv"
-
-    # Fetch and process desktop data, write to CSV without appending (creating the file or overwriting if it exists)
-    fetch_and_process_serp_data(
-            "desktop",
-            campaign_id,
-            current_date,
-            api_key,
-            keywords_augmented,
-            file_path,
-            schema,
-            append=False,
-        )
+        return final_df.fillna(''), quarantined.astype(object).fillna('')
 
-    # Fetch and process mobile data, append to the existing CSV
-    fetch_and_process_serp_data(
-        "mobile",
+    def fetch_and_process_serp_data(
+        device_type,
         campaign_id,
-        current_date,
+        date_str,
         api_key,
         keywords_augmented,
-        file_path,
         schema,
-        append=True,
-    )
-
-    # Step 5, moving the data to GCS
-    from google.cloud import storage
-
-    storage_client = storage.Client(project="organic-data")
+        validator,
+        quarantine,
+        sinks,
+        plan,
+    ):
+        # Debugging print to check columns before the merge
+        print("Columns in keywords_augmented:", keywords_augmented.columns)
 
-    bucket_name = "rankflux"
-    destination_blob_name = f"{dest_file_name}.csv"
+        # Ensure all necessary columns are present in keywords_augmented
+        required_columns = ['keyword_id', 'keyword', 'main_keyword_id', 'search_data.search_volume',
+                            'variant_flag', 'group_name', 'parent_id', 'main_keyword']
+        for column in required_columns:
+            if column not in keywords_augmented.columns:
+                print(f"Warning: '{column}' column not found in keywords_augmented")
+                keywords_augmented[column] = ''
 
-    # Get the bucket
-    bucket = storage_client.bucket(bucket_name)
+        # Rename columns to match schema
+        column_renames = {
+            'search_data.search_volume': 'search_volume',
+            'parent_id': 'parent_group_id'
+        }
+        keywords_augmented = keywords_augmented.rename(columns=column_renames)
 
-    # Create a blob and upload the file
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(file_path)
+        # Pages download in the background while the current one is transformed
+        # and written, the bounded queue stops downloads running too far ahead
+        pages = pipeline.background_iter(
+            iter_serp_pages(device_type, campaign_id, date_str, api_key, plan)
+        )
+        pages_written = 0
+        for serp_flat in pages:
+            # Drop keywords and depth outside the fetch plan before the merge
+            serp_flat = plan.trim(serp_flat, device_type)
+            final_df, quarantined = transform_serp_page(
+                serp_flat, keywords_augmented, campaign_id, date_str, device_type, schema, validator
+            )
+            if pages_written == 0:
+                # Debugging print to check columns after the merge
+                print("Columns in final_df after merge:", final_df.columns)
+            quarantine.write_frame(quarantined)
+            # Hand the clean page to the export and every in-pipeline consumer
+            for sink in sinks:
+                sink(final_df)
+            pages_written += 1
+        print(f"Completed fetching and saving all {device_type} data.")
 
-    print(
-        f"File {file_path} uploaded to {destination_blob_name} in bucket {bucket_name}."
-    )
+    # Step 5, moving the data to GCS
+    # Rows are written into gzip CSV chunks that upload concurrently as soon as
+    # they fill up, so uploading overlaps with fetching the remaining pages
+    bucket_name = "rankflux"
 
-    # Final step, move to BQ 
+    if local_bucket_dir:
+        # Write the chunks to a local directory instead of GCS
+        bucket = gcs_export.LocalBucket(local_bucket_dir, bucket_name)
+    else:
+        storage_client = get_storage_client()
+        bucket = storage_client.bucket(bucket_name)
+
+    # Every run gets its own prefix so the wildcard only matches this run's chunks
+    run_stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+    export_prefix = f"{dest_file_name}/{run_stamp}"
+    export = gcs_export.ChunkedExport(bucket, export_prefix)
+
+    # Rows failing validation go to a quarantine export with their reasons,
+    # outside the export prefix so they are never loaded
+    validator = serp_validator.SerpValidator(schema)
+    quarantine = gcs_export.ChunkedExport(bucket, f"{dest_file_name}/quarantine/{run_stamp}")
+
+    # An export that fails partway is torn down so its temp dir, partial chunk and
+    # uploader threads do not outlive the run, /tmp is memory on Cloud Functions
+    # and survives warm invocations
+    try:
+        # Daily domain x group x device visibility, computed from the pages as they pass
+        visibility = serp_aggregates.VisibilityAggregator(campaign_id, date_str)
+
+        # Every clean page goes to the export and the in-pipeline aggregates
+        sinks = [export.write_frame, visibility.add]
+
+        # Optionally keep the local rank history for the tracked domain up to date
+        history = None
+        if history_dir and history_domain:
+            history = rank_history.RankHistoryStore(history_dir)
+            sinks.append(lambda df: history.update_from_serps(date_str, df, history_domain))
+
+        # Plan which keywords to keep and how deep, and which devices to fetch at all
+        plan = fetch_plan.FetchPlan(keywords_augmented, **fetch_plan.rules_from_env())
+        print(f"Fetch plan: {plan.describe()}")
+
+        # Fetch and process desktop then mobile data into the same export
+        for device_type in ["desktop", "mobile"]:
+            if not plan.should_fetch(device_type):
+                print(f"Skipping {device_type} SERP data, not needed by the fetch plan.")
+                continue
+            fetch_and_process_serp_data(
+                device_type,
+                campaign_id,
+                date_str,
+                api_key,
+                keywords_augmented,
+                schema,
+                validator,
+                quarantine,
+                sinks,
+                plan,
+            )
+        plan.report()
+        validator.report()
+        if history is not None:
+            history.flush()
+            print(f"Rank history for {history_domain} updated in {history_dir}.")
+
+        # Wait for the remaining uploads before loading
+        export.close()
+        quarantine.close()
+    finally:
+        # Nothing to do for exports that closed normally
+        export.abort()
+        quarantine.abort()
+
+    if export.chunks == 0:
+        print("No SERP data to load into BigQuery.")
+        return
+
+    # Final step, move to BQ
     from google.cloud import bigquery
 
     project_id = "organic-data-361613"
-    bucket_name = "rankflux"
-    destination_blob_name = f"{dest_file_name}.csv"
     dataset_id = "rankflux_data"
     table_id = f"{campaign_id}_serps"
-    uri = f"gs://{bucket_name}/{destination_blob_name}"
 
-    # Initialize a BigQuery client
-    client = bigquery.Client(project=project_id)
+    # Reuse the instance-wide BigQuery client
+    client = get_bigquery_client(project_id)
 
     # Configure the load job
     job_config = bigquery.LoadJobConfig(
         autodetect=False,
-        schema=schema,
+        schema=get_bigquery_schema(schema),
         source_format=bigquery.SourceFormat.CSV,
         skip_leading_rows=0,
         write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
@@ -380,16 +677,58 @@ def main(request=None):
     )
 
     # Start the load job
-    load_job = client.load_table_from_uri(
-        uri, f"{dataset_id}.{table_id}", job_config=job_config
-    )
+    # One load job over every chunk, BigQuery reads gzip CSV directly
+    uri = export.uri
+    # Target today's partition directly through its decorator
+    partition = f"{dataset_id}.{table_id}${date_str.replace('-', '')}"
 
     try:
+        # Make sure the table exists, partitioned by date and clustered
+        create_partitioned_table(client, dataset_id, table_id, schema, serp_clustering_fields)
+
+        load_job = client.load_table_from_uri(
+            uri, partition, job_config=job_config
+        )
         load_job.result()  # Waits for the job to complete
         print(f"Loaded data from {uri} into {dataset_id}.{table_id} in BigQuery.")
+        # The export has landed, so the page checkpoints for today are no longer needed
+        serp_checkpoint.clear_checkpoints(campaign_id, date_str)
     except Exception as e:
         print(f"Failed to load data from {uri} into BigQuery: {e}")
         return "Process encountered an error"
+    finally:
+        # Each run exports under its own prefix, so the chunks are always removed
+        # rather than piling up in the bucket. A failed load keeps its checkpoints,
+        # and the rerun rebuilds the export from them.
+        export.delete()
+
+    # Load the visibility aggregates alongside the raw rows. The SERP rows have
+    # already landed at this point, so a failure here must not lead to a rerun.
+    visibility_table_id = f"{campaign_id}_visibility"
+    try:
+        create_partitioned_table(
+            client, dataset_id, visibility_table_id, serp_aggregates.schema, visibility_clustering_fields
+        )
+        visibility_df = visibility.result()
+        visibility_config = bigquery.LoadJobConfig(
+            schema=get_bigquery_schema(serp_aggregates.schema),
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        # Round-trip through JSON so the rows hold plain Python values
+        visibility_rows = json.loads(visibility_df.to_json(orient="records"))
+        client.load_table_from_json(
+            visibility_rows,
+            f"{dataset_id}.{visibility_table_id}${date_str.replace('-', '')}",
+            job_config=visibility_config,
+        ).result()
+        print(f"Loaded {len(visibility_rows)} visibility rows into {dataset_id}.{visibility_table_id}.")
+    except Exception as e:
+        print(
+            f"SERP data loaded, but loading the visibility aggregates into "
+            f"{dataset_id}.{visibility_table_id} failed: {e}"
+        )
+        return "Visibility aggregates failed to load"
 
 if __name__ == "__main__":
     main()
@@ -3,6 +3,7 @@ import json
 import requests
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+import bq_chunked_loader
 from datetime import datetime, timedelta
 
 # Helper function to generate date range
@@ -133,7 +134,6 @@ def process_json_file(file_path, location_name, campaign_id, specified_date):
     def clean_value(value):
         return None if value == "N/A" else value
 
-    flattened_data = []
     for entry in json_data:
         search_data = entry.get("search_data", {})
         landing_pages = entry.get("landing_pages", {})
@@ -174,10 +174,27 @@ def process_json_file(file_path, location_name, campaign_id, specified_date):
             "opportunity_avg_cpc": clean_value(opportunity_data.get("avg_cpc", 0)),
             "additional_monthly_sessions": clean_value(opportunity_data.get("additional_monthly_sessions", 0))
         }
-        flattened_data.append(flattened_entry)
-    
-    return flattened_data
+        yield flattened_entry
+
+
+# Yield the flattened rows of each campaign's JSON file for a date, deleting
+# each file once its rows have been consumed
+def iter_campaign_rows(campaigns, specified_date):
+    for campaign in campaigns:
+        location_name = campaign["Name"]
+        campaign_id = campaign["ID"]
+        file_path = f"keywords_{location_name.replace(' ', '_')}_{specified_date}.json"
+
+        if os.path.exists(file_path):
+            print(f"Processing file: {file_path}")
+            # Pass the dynamic date to the function
+            yield from process_json_file(file_path, location_name, campaign_id, specified_date)
 
+            # Remove the JSON file after processing to save space
+            os.remove(file_path)
+            print(f"File {file_path} deleted after processing.")
+        else:
+            print(f"File not found: {file_path}")
 
 # Function to load data into BigQuery
 def load_data_to_bigquery(client, dataset_id, table_id, data):
@@ -187,10 +204,12 @@ def load_data_to_bigquery(client, dataset_id, table_id, data):
         write_disposition="WRITE_APPEND",
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
     )
-    
-    load_job = client.load_table_from_json(data, table_ref, job_config=job_config)
-    load_job.result()
-    print(f"Loaded {len(data)} rows into {dataset_id}.{table_id}.")
+
+    # Stream the rows in size-bounded NDJSON chunks loaded by concurrent jobs into a
+    # staging table, then append it to the target in one copy job
+    loaded_rows = bq_chunked_loader.load_rows_in_chunks(client, table_ref, data, job_config)
+    print(f"Loaded {loaded_rows} rows into {dataset_id}.{table_id}.")
+    return loaded_rows
 
 # Main function to handle both fetch and load
 # Main function to handle both fetch and load
@@ -208,28 +227,11 @@ def main():
         # Fetch data for all campaigns for the current date
         fetch_data(campaigns, specified_date)
         
-        # Load fetched data to BigQuery
-        all_data = []
-        for campaign in campaigns:
-            location_name = campaign["Name"]
-            campaign_id = campaign["ID"]
-            file_path = f"keywords_{location_name.replace(' ', '_')}_{specified_date}.json"
-            
-            if os.path.exists(file_path):
-                print(f"Processing file: {file_path}")
-                # Pass the dynamic date to the function
-                flattened_data = process_json_file(file_path, location_name, campaign_id, specified_date)
-                all_data.extend(flattened_data)
-
-                # Remove the JSON file after processing to save space
-                os.remove(file_path)
-                print(f"File {file_path} deleted after processing.")
-            else:
-                print(f"File not found: {file_path}")
-        
-        if all_data:
-            load_data_to_bigquery(client, dataset_id, table_id, all_data)
-        else:
+        # Stream the rows of every campaign file to BigQuery in bounded chunks
+        loaded_rows = load_data_to_bigquery(
+            client, dataset_id, table_id, iter_campaign_rows(campaigns, specified_date)
+        )
+        if not loaded_rows:
             print(f"No data to load for date: {specified_date}")
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import json
 import pandas as pd
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+import bq_chunked_loader
 
 # Load environment variables
 if os.path.exists('.env'):
@@ -95,11 +96,12 @@ def load_data_to_bigquery(client, dataset_id, table_id, data):
         write_disposition="WRITE_APPEND",  # Append to the table if it exists
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
     )
-    
-    # Load the data
-    load_job = client.load_table_from_json(data, table_ref, job_config=job_config)
-    load_job.result()  # Wait for the job to complete
-    print(f"Loaded {len(data)} rows into {dataset_id}.{table_id}.")
+
+    # Stream the rows in size-bounded NDJSON chunks loaded by concurrent jobs into a
+    # staging table, then append it to the target in one copy job
+    loaded_rows = bq_chunked_loader.load_rows_in_chunks(client, table_ref, data, job_config)
+    print(f"Loaded {loaded_rows} rows into {dataset_id}.{table_id}.")
+    return loaded_rows
 
 # Flatten and process JSON data with cleaning
 def process_json_file(file_path, location_name, campaign_id):
@@ -111,7 +113,6 @@ def process_json_file(file_path, location_name, campaign_id):
         return None if value == "N/A" else value
 
     # Process each entry in JSON
-    flattened_data = []
     for entry in json_data:
         # Extract values from nested keys and clean them
         search_data = entry.get("search_data", {})
@@ -160,36 +161,31 @@ def process_json_file(file_path, location_name, campaign_id):
             "opportunity_avg_cpc": clean_value(opportunity_data.get("avg_cpc", 0)),
             "additional_monthly_sessions": clean_value(opportunity_data.get("additional_monthly_sessions", 0))
         }
-        flattened_data.append(flattened_entry)
-    
-    return flattened_data
+        yield flattened_entry
 
-# Main function
-def main():
-    # Ensure the BigQuery table exists
-    create_bigquery_table(client, dataset_id, table_id, schema)
-    
-    all_data = []
-    
-    # Iterate over campaigns and load data
+# Yield the flattened rows of each campaign's JSON file
+def iter_campaign_rows(campaigns):
     for campaign in campaigns:
         location_name = campaign["Name"]
         campaign_id = campaign["ID"]
-        
+
         # File path based on location name
         file_path = f"keywords_{location_name.replace(' ', '_')}_2024-10-01.json"
-        
+
         if os.path.exists(file_path):
             print(f"Processing file: {file_path}")
-            flattened_data = process_json_file(file_path, location_name, campaign_id)
-            all_data.extend(flattened_data)
+            yield from process_json_file(file_path, location_name, campaign_id)
         else:
             print(f"File not found: {file_path}")
+
+# Main function
+def main():
+    # Ensure the BigQuery table exists
+    create_bigquery_table(client, dataset_id, table_id, schema)
     
-    # Load all collected data to BigQuery
-    if all_data:
-        load_data_to_bigquery(client, dataset_id, table_id, all_data)
-    else:
+    # Stream the rows of every campaign file to BigQuery in bounded chunks
+    loaded_rows = load_data_to_bigquery(client, dataset_id, table_id, iter_campaign_rows(campaigns))
+    if not loaded_rows:
         print("No data to load.")
 
 if __name__ == "__main__":
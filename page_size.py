@@ -0,0 +1,76 @@
+# Adaptive page sizes for the paginated SEOmonitor endpoints. The size grows
+# while pages come back quickly and small, shrinks on slow or oversized pages,
+# halves on timeouts and 524s and falls back to the largest size the API is
+# known to accept when a bigger one is refused. The tuned value is remembered
+# per campaign and endpoint between runs.
+
+import json
+
+import serp_checkpoint
+
+# Page latency to aim for, well inside the 100 second gateway timeout behind the 524s
+target_seconds = 20.0
+# Largest response body to aim for
+target_bytes = 50 * 1024 * 1024
+
+grow_factor = 1.5
+shrink_factor = 0.75
+
+state_prefix = "page_sizes"
+
+
+class PageSizeController:
+    def __init__(self, campaign_id, endpoint, initial, min_size, max_size):
+        self.campaign_id = campaign_id
+        self.endpoint = endpoint
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = self._clamp(self._load() or initial)
+        print(f"Using page size {self.size} for {endpoint} (campaign {campaign_id})")
+
+    def _clamp(self, size):
+        return int(min(max(size, self.min_size), self.max_size))
+
+    def _state_name(self):
+        return f"{state_prefix}/{self.campaign_id}/{self.endpoint}.json"
+
+    def _load(self):
+        data = serp_checkpoint.read_object(self._state_name())
+        if data is None:
+            return None
+        return json.loads(data).get("size")
+
+    # Remember the tuned size for the next run
+    def save(self):
+        data = json.dumps({"size": self.size}).encode("utf-8")
+        serp_checkpoint.write_object(self._state_name(), data)
+
+    # Adjust after a successful page. payload_bytes may be None when the
+    # response did not report its length.
+    def record_success(self, seconds, payload_bytes=None):
+        too_slow = seconds > target_seconds
+        too_large = payload_bytes is not None and payload_bytes > target_bytes
+        has_headroom = seconds < target_seconds / 2 and (
+            payload_bytes is None or payload_bytes < target_bytes / 2
+        )
+
+        if too_slow or too_large:
+            self._resize(self.size * shrink_factor, f"{seconds:.1f}s, {payload_bytes} bytes")
+        elif has_headroom:
+            self._resize(self.size * grow_factor, f"{seconds:.1f}s, {payload_bytes} bytes")
+
+    # Halve after a timeout, 524 or other gateway error
+    def record_failure(self, reason):
+        self._resize(self.size / 2, reason)
+
+    # The API refused a page larger than accepted_size, the largest size it is
+    # known to take, so go back to that and stay there for the rest of the run
+    def record_refused(self, size, accepted_size):
+        self.max_size = max(min(self.max_size, accepted_size), self.min_size)
+        self._resize(accepted_size, f"size {size} refused")
+
+    def _resize(self, size, reason):
+        size = self._clamp(size)
+        if size != self.size:
+            print(f"Page size for {self.endpoint} {self.size} -> {size} ({reason})")
+            self.size = size
@@ -0,0 +1,128 @@
+# Producer/consumer helpers used by main.py to overlap network I/O with pandas
+# work. Every hand-off goes through a bounded queue, so a stage that falls
+# behind blocks the one feeding it instead of buffering without limit.
+
+import queue
+import threading
+
+# Default number of items a queue holds before the producer blocks
+default_maxsize = 2
+
+# Marks the end of a queue
+_DONE = object()
+
+
+# Carries an exception from a worker thread back to the consuming thread
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+# Put an item on a bounded queue, giving up if the consumer has gone away
+def _put(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# Run an iterable in a background thread and yield its items in order, so the
+# next item is being produced while the caller works on the current one
+def background_iter(iterable, maxsize=default_maxsize):
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, item, stop):
+                    return
+        except BaseException as error:
+            _put(items, _Failure(error), stop)
+            return
+        _put(items, _DONE, stop)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Run a single call in a background thread, result() waits for it and
+# re-raises anything it raised
+class BackgroundCall:
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(func, args, kwargs), daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException as error:
+            self._error = error
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+# Feed items to func on worker threads. submit() blocks while the queue is
+# full, close() waits for the queue to drain and re-raises the first failure.
+class BackgroundWorker:
+    def __init__(self, func, maxsize=default_maxsize, workers=1):
+        self._func = func
+        self._items = queue.Queue(maxsize)
+        self._error = None
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            item = self._items.get()
+            if item is _DONE:
+                return
+            if self._error is not None:
+                continue  # Drain the queue without doing more work after a failure
+            try:
+                self._func(item)
+            except BaseException as error:
+                with self._lock:
+                    if self._error is None:
+                        self._error = error
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, item):
+        self._raise_error()
+        self._items.put(item)
+
+    def close(self):
+        for _ in self._threads:
+            self._items.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+        self._raise_error()
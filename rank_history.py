@@ -0,0 +1,229 @@
+# Local rank history for a tracked domain, kept in memory-mapped NumPy arrays
+# so trend questions can be answered without a BigQuery scan.
+#
+# Layout of the store directory:
+#   ranks.npy  int16 [series, days]  -1 no data, 0 not in the results, 1-100 rank
+#   pages.npy  int32 [series, days]  landing page id, -1 if none
+#   index.json series keys (keyword_id, device), landing page strings, start date
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+NO_DATA = -1
+NOT_RANKED = 0
+# Rank used for "not in the results" when working out movement
+UNRANKED_POSITION = 101
+
+initial_series = 1024
+initial_days = 128
+
+
+# Ranks as nullable integers with <NA> where the domain did not rank, as
+# series() returns them
+def _nullable_ranks(ranks):
+    return pd.arrays.IntegerArray(ranks.astype(np.int64), ranks == NOT_RANKED)
+
+
+class RankHistoryStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "index.json")
+        self._ranks_path = os.path.join(path, "ranks.npy")
+        self._pages_path = os.path.join(path, "pages.npy")
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r", encoding="utf-8") as file:
+                index = json.load(file)
+            self.start_date = np.datetime64(index["start_date"], "D") if index["start_date"] else None
+            self.keyword_ids = index["keyword_ids"]
+            self.devices = index["devices"]
+            self.pages = index["pages"]
+            self.ranks = np.load(self._ranks_path, mmap_mode="r+")
+            self.page_ids = np.load(self._pages_path, mmap_mode="r+")
+        else:
+            self.start_date = None
+            self.keyword_ids = []
+            self.devices = []
+            self.pages = []
+            self.ranks = self._create(self._ranks_path, np.int16, (initial_series, initial_days))
+            self.page_ids = self._create(self._pages_path, np.int32, (initial_series, initial_days))
+
+        # (keyword_id, device) -> row index
+        self.rows = {}
+        for row, (keyword_id, device) in enumerate(zip(self.keyword_ids, self.devices)):
+            self.rows[(keyword_id, device)] = row
+        self.page_lookup = {page: page_id for page_id, page in enumerate(self.pages)}
+
+    @staticmethod
+    def _create(path, dtype, shape):
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        array[:] = NO_DATA
+        return array
+
+    # Grow the arrays to hold more series or days, shifting existing days right
+    # by `shift` columns when a date before the current start is written
+    def _resize(self, series, days, shift=0):
+        for name, dtype in [("ranks", np.int16), ("page_ids", np.int32)]:
+            old = getattr(self, name)
+            path = self._ranks_path if name == "ranks" else self._pages_path
+            tmp_path = f"{path}.tmp.npy"
+            new = self._create(tmp_path, dtype, (series, days))
+            new[:old.shape[0], shift:shift + old.shape[1]] = old
+            new.flush()
+            del new
+            old.flush()
+            setattr(self, name, None)
+            del old
+            os.replace(tmp_path, path)
+            setattr(self, name, np.load(path, mmap_mode="r+"))
+
+    # Days between the start of the store and a date
+    def _offset(self, date_str):
+        return int((np.datetime64(date_str, "D") - self.start_date).astype(int))
+
+    # Column for a date, growing the arrays if the date is outside them
+    def _column(self, date_str, create=False):
+        date = np.datetime64(date_str, "D")
+        if self.start_date is None:
+            if not create:
+                return None
+            self.start_date = date
+        column = self._offset(date_str)
+        if not create:
+            return column if 0 <= column < self.ranks.shape[1] else None
+
+        series, days = self.ranks.shape
+        if column < 0:
+            self._resize(series, max(days * 2, days - column), shift=-column)
+            self.start_date = date
+            column = 0
+        elif column >= days:
+            self._resize(series, max(days * 2, column + 1))
+        return column
+
+    # Rows for (keyword_id, device) keys, adding new series as needed
+    def _series_rows(self, keyword_ids, devices):
+        rows = np.empty(len(keyword_ids), dtype=np.int64)
+        for i, key in enumerate(zip(keyword_ids, devices)):
+            row = self.rows.get(key)
+            if row is None:
+                row = len(self.keyword_ids)
+                self.rows[key] = row
+                self.keyword_ids.append(key[0])
+                self.devices.append(key[1])
+            rows[i] = row
+
+        series, days = self.ranks.shape
+        if len(self.keyword_ids) > series:
+            self._resize(max(series * 2, len(self.keyword_ids)), days)
+        return rows
+
+    def _page_id(self, page):
+        page_id = self.page_lookup.get(page)
+        if page_id is None:
+            page_id = len(self.pages)
+            self.pages.append(page)
+            self.page_lookup[page] = page_id
+        return page_id
+
+    # Record one page of exported SERP rows for a date. Every keyword on the
+    # page gets a value, NOT_RANKED if the domain is not in its results.
+    def update_from_serps(self, date_str, serp_df, domain):
+        if serp_df.empty:
+            return
+        column = self._column(date_str, create=True)
+        domain = domain.lower()
+
+        keys = serp_df[["keyword_id", "device"]].astype(str).drop_duplicates()
+        rows = self._series_rows(keys["keyword_id"].tolist(), keys["device"].tolist())
+        self.ranks[rows, column] = NOT_RANKED
+        self.page_ids[rows, column] = -1
+
+        domains = serp_df["domain"].astype(str).str.lower()
+        matches = serp_df[(domains == domain) | domains.str.endswith("." + domain)]
+        if matches.empty:
+            return
+        # Keep the best ranking result per keyword and device
+        best = (
+            matches.assign(rank=pd.to_numeric(matches["rank"], errors="coerce"))
+            .dropna(subset=["rank"])
+            .sort_values("rank")
+            .drop_duplicates(["keyword_id", "device"])
+        )
+        rows = self._series_rows(best["keyword_id"].astype(str).tolist(), best["device"].astype(str).tolist())
+        self.ranks[rows, column] = best["rank"].to_numpy().astype(np.int16)
+        self.page_ids[rows, column] = [self._page_id(page) for page in best["landing_page"].astype(str)]
+
+    # Write the arrays and index to disk
+    def flush(self):
+        self.ranks.flush()
+        self.page_ids.flush()
+        index = {
+            "start_date": str(self.start_date) if self.start_date is not None else None,
+            "keyword_ids": self.keyword_ids,
+            "devices": self.devices,
+            "pages": self.pages,
+        }
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(index, file)
+        os.replace(tmp_path, self._index_path)
+
+    # Rank and landing page series for one keyword and device, indexed by date.
+    # Days without data are left out, rank is <NA> when the domain did not rank.
+    def series(self, keyword_id, device, start=None, end=None):
+        row = self.rows.get((str(keyword_id), device))
+        if row is None or self.start_date is None:
+            return pd.DataFrame(columns=["rank", "landing_page"])
+
+        width = self.ranks.shape[1]
+        first = 0 if start is None else min(max(self._offset(start), 0), width)
+        last = width if end is None else min(max(self._offset(end) + 1, 0), width)
+        ranks = np.asarray(self.ranks[row, first:last])
+        page_ids = np.asarray(self.page_ids[row, first:last])
+        days = np.flatnonzero(ranks != NO_DATA)
+
+        dates = self.start_date + (first + days).astype("timedelta64[D]")
+        rank = _nullable_ranks(ranks[days])
+        pages = [self.pages[page_id] if page_id >= 0 else None for page_id in page_ids[days]]
+        return pd.DataFrame({"rank": rank, "landing_page": pages}, index=pd.DatetimeIndex(dates, name="date"))
+
+    # Rank changes between a date and `days` earlier, for every series with
+    # data on both days. change is positive when the rank improved, ranks are
+    # <NA> where the domain did not rank.
+    def diff(self, date_str, days=1, device=None):
+        current = self._column(date_str)
+        previous = None if current is None else current - days
+        if current is None or previous < 0:
+            return pd.DataFrame(columns=["keyword_id", "device", "previous_rank", "rank", "change"])
+
+        count = len(self.keyword_ids)
+        now = np.asarray(self.ranks[:count, current]).astype(np.int32)
+        before = np.asarray(self.ranks[:count, previous]).astype(np.int32)
+        keep = (now != NO_DATA) & (before != NO_DATA)
+        if device is not None:
+            keep &= np.asarray(self.devices) == device
+
+        now_position = np.where(now == NOT_RANKED, UNRANKED_POSITION, now)
+        before_position = np.where(before == NOT_RANKED, UNRANKED_POSITION, before)
+        change = before_position - now_position
+        keep &= change != 0
+
+        rows = np.flatnonzero(keep)
+        return pd.DataFrame({
+            "keyword_id": np.asarray(self.keyword_ids, dtype=object)[rows],
+            "device": np.asarray(self.devices, dtype=object)[rows],
+            "previous_rank": _nullable_ranks(before[rows]),
+            "rank": _nullable_ranks(now[rows]),
+            "change": change[rows],
+        })
+
+    # The n series whose rank moved most between a date and `days` earlier
+    def top_movers(self, date_str, days=1, n=10, device=None):
+        changes = self.diff(date_str, days=days, device=device)
+        order = changes["change"].abs().sort_values(ascending=False, kind="stable").index
+        return changes.loc[order].head(n).reset_index(drop=True)
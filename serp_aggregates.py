@@ -0,0 +1,104 @@
+# Daily domain x group x device visibility aggregates, computed in-pipeline
+# from the SERP pages main.py already holds in memory
+
+import numpy as np
+import pandas as pd
+
+# Estimated click-through rate by rank (index 0 unused), ranks past 20 get none
+ctr_curve = np.array([
+    0.0,
+    0.284, 0.157, 0.110, 0.080, 0.072, 0.051, 0.040, 0.032, 0.028, 0.025,
+    0.013, 0.012, 0.011, 0.010, 0.009, 0.008, 0.007, 0.006, 0.005, 0.004,
+])
+
+# Label for keywords outside every group
+ungrouped = "(ungrouped)"
+
+# BigQuery schema of the aggregate table, as (name, type) pairs like main.schema
+schema = [
+    ("date", "DATE"),
+    ("campaign_id", "STRING"),
+    ("device", "STRING"),
+    ("group_name", "STRING"),
+    ("domain", "STRING"),
+    ("keywords", "INTEGER"),
+    ("top_3", "INTEGER"),
+    ("top_10", "INTEGER"),
+    ("visibility", "FLOAT"),
+    ("estimated_traffic", "FLOAT"),
+    ("traffic_share", "FLOAT"),
+]
+
+_keys = ["group_name", "device", "domain"]
+
+
+def _ctr(ranks):
+    ranks = np.asarray(ranks, dtype=np.int64)
+    valid = (ranks > 0) & (ranks < len(ctr_curve))
+    return np.where(valid, ctr_curve[np.where(valid, ranks, 0)], 0.0)
+
+
+# Accumulates per-page partial sums, so only the compact aggregate is kept
+class VisibilityAggregator:
+    def __init__(self, campaign_id, date_str):
+        self.campaign_id = campaign_id
+        self.date_str = date_str
+        self._partials = []
+        self._volumes = []
+
+    # Add one exported page (the cleaned frame written to the CSV)
+    def add(self, final_df):
+        if final_df.empty:
+            return
+        df = final_df[["keyword_id", "domain", "rank", "search_volume", "group_name", "device"]]
+        # A keyword counts towards every group it belongs to
+        groups = df["group_name"].replace("", ungrouped).str.split(", ")
+        df = df.assign(group_name=groups).explode("group_name")
+
+        # Total search volume per group and device, one row per keyword
+        keywords = df.drop_duplicates(["keyword_id", "group_name", "device"])
+        self._volumes.append(
+            keywords.groupby(["group_name", "device"])["search_volume"].sum()
+        )
+
+        # Only the best result of a domain counts for a keyword
+        best = df.sort_values("rank").drop_duplicates(["keyword_id", "group_name", "device", "domain"])
+        ranks = best["rank"].to_numpy()
+        best = best.assign(
+            top_3=ranks <= 3,
+            top_10=ranks <= 10,
+            estimated_traffic=best["search_volume"].to_numpy() * _ctr(ranks),
+        )
+        self._partials.append(
+            best.groupby(_keys).agg(
+                keywords=("keyword_id", "size"),
+                top_3=("top_3", "sum"),
+                top_10=("top_10", "sum"),
+                estimated_traffic=("estimated_traffic", "sum"),
+            )
+        )
+
+    # Combine the partial sums into the daily aggregate table
+    def result(self):
+        if not self._partials:
+            return pd.DataFrame(columns=[name for name, _ in schema])
+
+        totals = pd.concat(self._partials).groupby(level=_keys).sum().reset_index()
+        volumes = (
+            pd.concat(self._volumes).groupby(level=["group_name", "device"]).sum()
+            .rename("search_volume").reset_index()
+        )
+        totals = totals.merge(volumes, on=["group_name", "device"], how="left")
+
+        # Visibility is traffic relative to ranking first for every keyword
+        best_possible = totals["search_volume"] * ctr_curve[1]
+        totals["visibility"] = np.where(
+            best_possible > 0, totals["estimated_traffic"] / best_possible, 0.0
+        )
+        group_traffic = totals.groupby(["group_name", "device"])["estimated_traffic"].transform("sum")
+        totals["traffic_share"] = np.where(
+            group_traffic > 0, totals["estimated_traffic"] / group_traffic, 0.0
+        )
+        totals["date"] = self.date_str
+        totals["campaign_id"] = str(self.campaign_id)
+        return totals[[name for name, _ in schema]]
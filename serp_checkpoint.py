@@ -0,0 +1,146 @@
+# Page-level checkpoints for the SERP fetch in main.py, so a run that dies
+# partway through paging can continue from the last completed page
+
+import os
+import gzip
+import pickle
+
+import gcp_clients
+
+# Checkpoints go to GCS when CHECKPOINT_BUCKET is set, otherwise to a local
+# directory. Deployed, /tmp is memory private to one instance, so it is lost
+# with the instance and adds to the memory that may have killed it.
+checkpoint_bucket = os.getenv("CHECKPOINT_BUCKET")
+checkpoint_dir = os.getenv("CHECKPOINT_DIR", "/tmp/serp_checkpoints")
+checkpoint_prefix = "serp_checkpoints"
+# Set by the Cloud Functions and Cloud Run runtimes
+deployed = bool(os.getenv("K_SERVICE") or os.getenv("FUNCTION_TARGET"))
+
+# Name of the marker written once every page of a device has been fetched
+COMPLETE_MARKER = "_complete"
+
+
+# Lazily resolve the checkpoint bucket so local runs never touch GCS, through
+# the storage client main.py also uses
+def _get_bucket():
+    return gcp_clients.get_storage_client().bucket(checkpoint_bucket)
+
+
+# Refuse to checkpoint to local storage when deployed unless CHECKPOINT_DIR was
+# chosen explicitly, and say loudly where local checkpoints go otherwise
+def check_storage():
+    if checkpoint_bucket:
+        print(f"Checkpoints are kept in gs://{checkpoint_bucket}/{checkpoint_prefix}")
+        return
+    if deployed and not os.getenv("CHECKPOINT_DIR"):
+        raise RuntimeError(
+            "CHECKPOINT_BUCKET must be set when deployed, local checkpoints in /tmp "
+            "are held in memory and lost with the instance"
+        )
+    print(
+        f"WARNING: checkpoints are kept in the local directory {checkpoint_dir}, they do not "
+        f"survive the instance and count towards its memory when it is under /tmp. "
+        f"Set CHECKPOINT_BUCKET to keep them in GCS."
+    )
+
+
+# Checkpoint names are keyed by (campaign, date, device, offset)
+def _device_prefix(campaign_id, date_str, device_type):
+    return f"{checkpoint_prefix}/{campaign_id}/{date_str}/{device_type}"
+
+
+def _page_name(campaign_id, date_str, device_type, offset):
+    return f"{_device_prefix(campaign_id, date_str, device_type)}/{offset:08d}.pkl.gz"
+
+
+def _marker_name(campaign_id, date_str, device_type):
+    return f"{_device_prefix(campaign_id, date_str, device_type)}/{COMPLETE_MARKER}"
+
+
+# Read and write named objects in the checkpoint storage, also used by other
+# modules to keep small pieces of state between runs
+def read_object(name):
+    if checkpoint_bucket:
+        blob = _get_bucket().blob(name)
+        if not blob.exists():
+            return None
+        return blob.download_as_bytes()
+
+    path = os.path.join(checkpoint_dir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def write_object(name, data):
+    if checkpoint_bucket:
+        _get_bucket().blob(name).upload_from_string(data)
+        return
+
+    path = os.path.join(checkpoint_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so a crash never leaves half a page behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+# Load a previously fetched page, returns None if it was never completed
+def load_page(campaign_id, date_str, device_type, offset):
+    data = read_object(_page_name(campaign_id, date_str, device_type, offset))
+    if data is None:
+        return None
+    return pickle.loads(gzip.decompress(data))
+
+
+# Persist a fetched page together with the limit it was requested with, so a
+# resumed run knows where the next page starts
+def save_page(campaign_id, date_str, device_type, offset, limit, serp_flat):
+    page = {"offset": offset, "limit": limit, "frame": serp_flat}
+    data = gzip.compress(pickle.dumps(page, protocol=pickle.HIGHEST_PROTOCOL))
+    write_object(_page_name(campaign_id, date_str, device_type, offset), data)
+
+
+def mark_device_complete(campaign_id, date_str, device_type):
+    write_object(_marker_name(campaign_id, date_str, device_type), b"")
+
+
+def is_device_complete(campaign_id, date_str, device_type):
+    return read_object(_marker_name(campaign_id, date_str, device_type)) is not None
+
+
+# Remove every checkpoint for a campaign and date once the export has landed
+def clear_checkpoints(campaign_id, date_str):
+    prefix = f"{checkpoint_prefix}/{campaign_id}/{date_str}/"
+    if checkpoint_bucket:
+        for blob in _get_bucket().list_blobs(prefix=prefix):
+            blob.delete()
+        return
+
+    root = os.path.join(checkpoint_dir, prefix)
+    if not os.path.isdir(root):
+        return
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for filename in filenames:
+            os.remove(os.path.join(dirpath, filename))
+        os.rmdir(dirpath)
+
+
+# Remove the checkpoints of earlier dates for a campaign. Runs only ever resume
+# their own date, so pages of a date whose load never happened are dead weight.
+def clear_stale_checkpoints(campaign_id, date_str):
+    prefix = f"{checkpoint_prefix}/{campaign_id}/"
+    if checkpoint_bucket:
+        stale = set()
+        for blob in _get_bucket().list_blobs(prefix=prefix):
+            stale.add(blob.name[len(prefix):].split("/")[0])
+    else:
+        root = os.path.join(checkpoint_dir, prefix)
+        stale = set(os.listdir(root)) if os.path.isdir(root) else set()
+
+    for stale_date in sorted(stale):
+        if stale_date < date_str:
+            print(f"Removing stale checkpoints for {campaign_id} on {stale_date}")
+            clear_checkpoints(campaign_id, stale_date)
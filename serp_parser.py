@@ -0,0 +1,193 @@
+# Incremental parsing of top-results responses straight into column buffers,
+# so a page never has to be held as one big nested Python object graph
+
+import codecs
+import json
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# Size of the chunks read from the response body
+chunk_size = 64 * 1024
+
+# Keyword level fields attached to every result row
+META_COLUMNS = ["keyword_id", "keyword"]
+
+
+# Typed column buffers for the flattened top_100_results rows.
+# INTEGER fields are kept in int64 arrays with a null mask, everything else in lists.
+class SerpColumnBuffers:
+    def __init__(self, result_fields):
+        self.result_fields = result_fields
+        self.rows = 0
+        self.keywords = 0
+        self.ints = {}
+        self.masks = {}
+        self.objects = {name: [] for name in META_COLUMNS}
+        for name, field_type in result_fields:
+            if field_type == "INTEGER":
+                self.ints[name] = array("q")
+                self.masks[name] = bytearray()
+            else:
+                self.objects[name] = []
+
+    def _append_int(self, name, value):
+        try:
+            self.ints[name].append(int(value))
+            self.masks[name].append(0)
+        except (TypeError, ValueError, OverflowError):
+            # Missing or malformed values are stored as null
+            self.ints[name].append(0)
+            self.masks[name].append(1)
+
+    # Write every result of one keyword entry, with the keyword meta attached
+    def add_keyword(self, entry):
+        results = entry.get("top_100_results") or []
+        keyword_id = entry.get("keyword_id")
+        keyword = entry.get("keyword")
+        for result in results:
+            for name, field_type in self.result_fields:
+                value = result.get(name)
+                if field_type == "INTEGER":
+                    self._append_int(name, value)
+                else:
+                    self.objects[name].append(value)
+            self.objects["keyword_id"].append(keyword_id)
+            self.objects["keyword"].append(keyword)
+        self.rows += len(results)
+        self.keywords += 1
+
+    # Build the page DataFrame, result fields first then the keyword meta
+    def to_frame(self):
+        ints = {name: np.frombuffer(values, dtype=np.int64) for name, values in self.ints.items()}
+        masks = {name: np.frombuffer(mask, dtype=np.bool_) for name, mask in self.masks.items()}
+        return _build_frame(self.result_fields, ints, masks, self.objects)
+
+
+# Assemble the fixed set of page columns, so every page has the same columns in
+# the same order whatever fields the API left out
+def _build_frame(result_fields, ints, masks, objects):
+    columns = {}
+    for name, field_type in result_fields:
+        if field_type == "INTEGER":
+            columns[name] = pd.arrays.IntegerArray(ints[name].copy(), masks[name].copy())
+        else:
+            columns[name] = objects[name]
+    for name in META_COLUMNS:
+        columns[name] = objects[name]
+    # keyword_id is a nullable integer like the keyword list it is merged with,
+    # whether the API sent the ids as numbers or strings
+    columns["keyword_id"] = pd.to_numeric(
+        pd.Series(objects["keyword_id"], dtype=object), errors="raise"
+    ).astype("Int64")
+    return pd.DataFrame(columns)
+
+
+# Flatten an already parsed top-results page into the fixed column list.
+# Replaces pd.json_normalize(record_path=["top_100_results"], meta=META_COLUMNS):
+# the output is sized up front and missing fields become explicit nulls.
+def flatten_top_results(json_content, result_fields):
+    total = sum(len(entry.get("top_100_results") or []) for entry in json_content)
+
+    ints = {}
+    masks = {}
+    objects = {name: np.full(total, None, dtype=object) for name in META_COLUMNS}
+    for name, field_type in result_fields:
+        if field_type == "INTEGER":
+            ints[name] = np.zeros(total, dtype=np.int64)
+            masks[name] = np.ones(total, dtype=np.bool_)  # Null until a value is seen
+        else:
+            objects[name] = np.full(total, None, dtype=object)
+
+    keyword_ids = objects["keyword_id"]
+    keywords = objects["keyword"]
+    row = 0
+    for entry in json_content:
+        results = entry.get("top_100_results") or []
+        if not results:
+            continue
+        end = row + len(results)
+        keyword_ids[row:end] = entry.get("keyword_id")
+        keywords[row:end] = entry.get("keyword")
+        for name, field_type in result_fields:
+            if field_type == "INTEGER":
+                values = ints[name]
+                mask = masks[name]
+                for i, result in enumerate(results, row):
+                    value = result.get(name)
+                    if value is None:
+                        continue
+                    try:
+                        values[i] = int(value)
+                    except (TypeError, ValueError, OverflowError):
+                        continue
+                    mask[i] = False
+            else:
+                column = objects[name]
+                for i, result in enumerate(results, row):
+                    column[i] = result.get(name)
+        row = end
+
+    return _build_frame(result_fields, ints, masks, objects)
+
+
+# Yield the elements of a top level JSON array one at a time from an iterable
+# of byte chunks, only ever holding the unparsed tail of the body in memory
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    while True:
+        # Skip whitespace, the opening bracket and element separators
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,[":
+            if buffer[pos] == "[":
+                if started:
+                    break
+                started = True
+            pos += 1
+
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        if pos < len(buffer) and started:
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element is not complete yet, fall through and read more
+                if exhausted:
+                    raise
+            else:
+                yield element
+                pos = end
+                continue
+
+        if exhausted:
+            if buffer[pos:].strip():
+                raise ValueError("Truncated JSON array in response body")
+            return
+
+        # Drop the consumed part of the buffer before reading the next chunk
+        buffer = buffer[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            buffer += text_decoder.decode(b"", final=True)
+            exhausted = True
+        elif chunk:
+            buffer += text_decoder.decode(chunk)
+
+
+# Parse a streamed top-results response (requests.get(..., stream=True))
+# into a flattened page DataFrame. Returns the frame and the number of keyword
+# entries in the page, which is 0 past the end of the data.
+def stream_top_results(response, result_fields):
+    buffers = SerpColumnBuffers(result_fields)
+    for entry in iter_json_array(response.iter_content(chunk_size=chunk_size)):
+        buffers.add_keyword(entry)
+    return buffers.to_frame(), buffers.keywords
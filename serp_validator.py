@@ -0,0 +1,109 @@
+# Vectorized pre-load validation of SERP rows against the main.py schema.
+# Rows that would fail or corrupt the BigQuery load are split off with the
+# reasons they failed, so only clean rows are exported and loaded.
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Columns that must hold a value for a row to be loadable
+required_fields = ["domain", "rank", "keyword_id", "campaign_id", "date", "device"]
+
+# Valid positions in a top-100 result set
+rank_range = (1, 100)
+
+# Name of the column holding the failure reasons in quarantined rows
+REASON_COLUMN = "quarantine_reason"
+
+# Maximum string lengths in characters per column, from the environment, e.g.
+#   SERP_STRING_LIMITS=landing_page=2048,title=1024
+# None are enforced by default: BigQuery STRING columns have no length limit of
+# their own, and a row over its 100 MB CSV row limit counts towards the load's
+# max_bad_records rather than failing it.
+def string_limits_from_env():
+    limits = {}
+    for item in os.getenv("SERP_STRING_LIMITS", "").split(","):
+        if item.strip():
+            name, limit = item.split("=")
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+class SerpValidator:
+    def __init__(self, schema, string_limits=None):
+        self.schema = schema
+        self.string_limits = string_limits_from_env() if string_limits is None else string_limits
+        self.rows = 0
+        self.quarantined = 0
+        self.seconds = 0.0
+
+    # Return a boolean Series per failed check, keyed by its reason
+    def _checks(self, df):
+        checks = {}
+        for name, field_type in self.schema:
+            column = df[name]
+            if field_type == "STRING":
+                limit = self.string_limits.get(name)
+                if limit is not None and column.dtype == object:
+                    lengths = column.map(lambda value: len(value) if isinstance(value, str) else 0)
+                    checks[f"too_long_{name}"] = lengths.to_numpy() > limit
+                if name not in required_fields:
+                    continue  # Nothing else to check on optional strings
+
+            present = column.notna()
+            if field_type == "STRING" and column.dtype == object:
+                # Blank strings count as missing, as they would in the exported CSV.
+                # Values are tested one by one, as a left merge can leave object
+                # columns mixing strings with NaN, bools or numbers.
+                blank = column.map(lambda value: isinstance(value, str) and not value.strip())
+                present &= ~blank.astype(bool)
+
+            if name in required_fields:
+                checks[f"missing_{name}"] = ~present
+
+            if field_type == "INTEGER":
+                numbers = pd.to_numeric(column, errors="coerce")
+                checks[f"invalid_{name}"] = present & numbers.isna()
+                if name == "rank":
+                    low, high = rank_range
+                    checks["rank_out_of_range"] = numbers.notna() & ~numbers.between(low, high)
+            elif field_type == "DATE":
+                dates = pd.to_datetime(column, errors="coerce", format="%Y-%m-%d")
+                checks[f"invalid_{name}"] = present & dates.isna()
+            elif field_type == "BOOL":
+                valid = column.isin([True, False, 0, 1, "True", "False", "true", "false"])
+                checks[f"invalid_{name}"] = present & ~valid
+        return checks
+
+    # Split a merged SERP frame into (clean rows, quarantined rows with reasons)
+    def validate(self, df):
+        start = time.perf_counter()
+        checks = self._checks(df)
+
+        failed = np.zeros(len(df), dtype=bool)
+        for mask in checks.values():
+            failed |= np.asarray(mask, dtype=bool)
+
+        clean = df[~failed]
+        quarantined = df[failed].copy()
+        if len(quarantined):
+            # Build the reason text only for the failed rows
+            reasons = pd.Series("", index=quarantined.index, dtype=object)
+            for reason, mask in checks.items():
+                hits = np.asarray(mask, dtype=bool)[failed]
+                reasons = reasons + np.where(hits, f"{reason};", "")
+            quarantined[REASON_COLUMN] = reasons.str.rstrip(";")
+
+        self.rows += len(df)
+        self.quarantined += len(quarantined)
+        self.seconds += time.perf_counter() - start
+        return clean, quarantined
+
+    def report(self):
+        rate = self.rows / self.seconds if self.seconds else 0
+        print(
+            f"Validated {self.rows} rows in {self.seconds:.2f} seconds ({rate:,.0f} rows/s), "
+            f"{self.quarantined} quarantined."
+        )
@@ -0,0 +1,73 @@
+import pandas as pd
+
+import main
+import serp_validator
+
+
+# A SERP page merged with the keyword list the way main.transform_serp_page does it
+def merged_page(keyword_ids):
+    serp_flat = pd.DataFrame({
+        "domain": ["a.com"] * len(keyword_ids),
+        "rank": pd.array(range(1, len(keyword_ids) + 1), dtype="Int64"),
+        "landing_page": ["https://a.com/"] * len(keyword_ids),
+        "title": ["Title"] * len(keyword_ids),
+        "description": [" "] * len(keyword_ids),
+        "search_intent": ["info"] * len(keyword_ids),
+        "keyword_id": pd.array(keyword_ids, dtype="Int64"),
+        "keyword": [f"kw {i}" for i in keyword_ids],
+    })
+    keywords_augmented = pd.DataFrame({
+        "keyword_id": pd.array([1, 2], dtype="Int64"),
+        "keyword": ["kw 1", "kw 2"],
+        "main_keyword_id": pd.array([None, 1], dtype="Int64"),
+        "search_volume": [10, 20],
+        "variant_flag": [False, True],
+        "group_name": ["G", "G"],
+        "parent_group_id": ["", ""],
+        "main_keyword": [None, "kw 1"],
+    })
+    df = pd.merge(serp_flat, keywords_augmented, how="left", on="keyword_id")
+    df = df.rename(columns={"keyword_x": "keyword"}).drop(columns=["keyword_y"])
+    df["campaign_id"] = "1"
+    df["date"] = "2026-10-19"
+    df["device"] = "Desktop"
+    return df
+
+
+def test_all_rows_clean():
+    clean, quarantined = serp_validator.SerpValidator(main.schema).validate(merged_page([1, 2]))
+    assert len(clean) == 2
+    assert quarantined.empty
+
+
+def test_keyword_missing_from_keyword_list():
+    # keyword 3 has results but is not in the keyword list, so the merge leaves
+    # variant_flag as an object column holding True and NaN
+    df = merged_page([2, 3])
+    assert df["variant_flag"].dtype == object
+
+    clean, quarantined = serp_validator.SerpValidator(main.schema).validate(df)
+    assert list(clean["keyword_id"]) == [2, 3]
+    assert quarantined.empty
+
+
+def test_blank_and_out_of_range_rows_quarantined():
+    df = merged_page([1, 2])
+    df.loc[0, "domain"] = "  "
+    df.loc[1, "rank"] = 300
+
+    clean, quarantined = serp_validator.SerpValidator(main.schema).validate(df)
+    assert clean.empty
+    assert list(quarantined[serp_validator.REASON_COLUMN]) == ["missing_domain", "rank_out_of_range"]
+
+
+def test_string_limits_are_opt_in():
+    df = merged_page([1])
+    df.loc[0, "landing_page"] = "https://a.com/" + "x" * 5000
+
+    clean, _ = serp_validator.SerpValidator(main.schema, string_limits={}).validate(df)
+    assert len(clean) == 1
+    _, quarantined = serp_validator.SerpValidator(
+        main.schema, string_limits={"landing_page": 2048}
+    ).validate(df)
+    assert list(quarantined[serp_validator.REASON_COLUMN]) == ["too_long_landing_page"]